@@ -7,8 +7,14 @@ from copy import deepcopy
 from torch.utils.data import Dataset
 
 
+class CombinedDataset(Dataset):
+    """Pairs unlabeled and labeled samples by index, so a single sampler shuffles both streams"""
+    def __init__(self, dataset_l, dataset_u):
+        self.dataset_l = dataset_l
+        self.dataset_u = dataset_u
 
+    def __len__(self):
+        return len(self.dataset_u)
 
-
-
-
+    def __getitem__(self, idx):
+        return self.dataset_l[idx % len(self.dataset_l)], self.dataset_u[idx]
@@ -0,0 +1,30 @@
+import os
+import argparse
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+
+# rerun after regenerating any 2022.h5, load_case ignores .npy files older than their h5
+parser = argparse.ArgumentParser(description='Unpack every 2022.h5 case into memory mappable .npy files')
+parser.add_argument('--base_dir', type=str, default='./27_FLARE2022', help='path of data')
+args = parser.parse_args()
+
+
+def convert_case(case_dir):
+    # image keeps its h5 dtype so training inputs match the h5 fallback in load_case, label is
+    # stored as the uint8 the datasets cast it to anyway
+    h5f = h5py.File(os.path.join(case_dir, '2022.h5'), 'r')
+    np.save(os.path.join(case_dir, 'image.npy'), h5f['image'][:])
+    if "label" in h5f.keys():
+        np.save(os.path.join(case_dir, 'label.npy'), h5f['label'][:].astype(np.uint8))
+    elif os.path.exists(os.path.join(case_dir, 'label.npy')):
+        os.remove(os.path.join(case_dir, 'label.npy'))
+    h5f.close()
+
+
+if __name__ == '__main__':
+    case_dirs = sorted(looproot for looproot, _, filenames in os.walk(args.base_dir) if '2022.h5' in filenames)
+    for case_dir in tqdm(case_dirs):
+        convert_case(case_dir)
+    print("converted {} cases".format(len(case_dirs)))
@@ -8,6 +8,33 @@ import itertools
 from torch.utils.data.sampler import Sampler
 
 
+def load_case(case_dir):
+    """Load image and label of a case, preferring the .npy copies written by preprocess_npy.py
+    :param case_dir: the directory holding 2022.h5
+    """
+    h5_path = os.path.join(case_dir, '2022.h5')
+    npy_path = os.path.join(case_dir, 'image.npy')
+    # .npy skips the h5 decompression; transforms like RandomRotFlip still copy the whole volume.
+    # a .npy older than its h5 is stale and ignored until preprocess_npy.py is rerun
+    if os.path.exists(npy_path) and (not os.path.exists(h5_path) or
+                                     os.path.getmtime(npy_path) >= os.path.getmtime(h5_path)):
+        image = np.load(npy_path, mmap_mode='r')
+        if os.path.exists(os.path.join(case_dir, 'label.npy')):
+            label = np.load(os.path.join(case_dir, 'label.npy'), mmap_mode='r')
+        else:
+            label = np.zeros(image.shape, dtype=np.uint8)
+        return image, label
+
+    h5f = h5py.File(h5_path, 'r')
+    image = h5f['image'][:]
+    if "label" in h5f.keys():
+        label = h5f['label'][:]
+    else:
+        label_shape = image.shape
+        label = np.zeros((label_shape), dtype=int, order='C')
+    return image, label
+
+
 class flare22(Dataset):
     """ flare22 Dataset """
     def __init__(self, base_dir=None, split='train', num=None, transform=None):
@@ -35,14 +62,8 @@ class flare22(Dataset):
 
     def __getitem__(self, idx):
         image_name = self.image_list[idx]
-        h5f = h5py.File(self._base_dir + "/{}/2022.h5".format(image_name), 'r')
-        image = h5f['image'][:]
-        if "label" in h5f.keys():
-            label = h5f['label'][:]
-        else:
-            label_shape = image.shape
-            label = np.zeros((label_shape), dtype=int, order='C')
-        sample = {'image': image, 'label': label.astype(np.uint8)}
+        image, label = load_case(self._base_dir + "/{}".format(image_name))
+        sample = {'image': image, 'label': label.astype(np.uint8, copy=False)}
         if self.transform:
             sample = self.transform(sample)
         sample["idx"] = idx
@@ -76,14 +97,8 @@ class amos22(Dataset):
 
     def __getitem__(self, idx):
         image_name = self.image_list[idx]
-        h5f = h5py.File(self._base_dir + "/{}/2022.h5".format(image_name), 'r')
-        image = h5f['image'][:]
-        if "label" in h5f.keys():
-            label = h5f['label'][:]
-        else:
-            label_shape = image.shape
-            label = np.zeros((label_shape), dtype=int, order='C')
-        sample = {'image': image, 'label': label.astype(np.uint8)}
+        image, label = load_case(self._base_dir + "/{}".format(image_name))
+        sample = {'image': image, 'label': label.astype(np.uint8, copy=False)}
         if self.transform:
             sample = self.transform(sample)
         sample["idx"] = idx
@@ -117,14 +132,8 @@ class BraTS2019(Dataset):
 
     def __getitem__(self, idx):
         image_name = self.image_list[idx]
-        h5f = h5py.File(self._base_dir + "/{}/2022.h5".format(image_name), 'r')
-        image = h5f['image'][:]
-        if "label" in h5f.keys():
-            label = h5f['label'][:]
-        else:
-            label_shape = image.shape
-            label = np.zeros((label_shape), dtype=int, order='C')
-        sample = {'image': image, 'label': label.astype(np.uint8)}
+        image, label = load_case(self._base_dir + "/{}".format(image_name))
+        sample = {'image': image, 'label': label.astype(np.uint8, copy=False)}
         if self.transform:
             sample = self.transform(sample)
         sample["idx"] = idx
@@ -262,12 +262,13 @@ def test_single_case(net, image, stride_xy, stride_z, patch_size, num_classes=1)
                 test_patch = np.expand_dims(np.expand_dims(
                     test_patch, axis=0), axis=0).astype(np.float32)
                 test_patch = torch.from_numpy(test_patch).cuda()
+                test_patch = test_patch.to(memory_format=torch.channels_last_3d)
 
-                with torch.no_grad():
+                with torch.no_grad(), torch.autocast('cuda', dtype=torch.float16):
                     y1 = net(test_patch)
                     # ensemble
                     y = torch.softmax(y1, dim=1)
-                y = y.cpu().data.numpy()
+                y = y.float().cpu().data.numpy()
                 y = y[0, :, :, :, :]
                 score_map[:, xs:xs+patch_size[0], ys:ys+patch_size[1], zs:zs+patch_size[2]] \
                     = score_map[:, xs:xs+patch_size[0], ys:ys+patch_size[1], zs:zs+patch_size[2]] + y
@@ -13,7 +13,7 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from torch.utils.data.distributed import DistributedSampler
 
-from dataset.dataset import Flare3Dataset
+from dataset.dataset import Flare3Dataset, CombinedDataset
 from model.unet_3d import unet_3D_mt, kaiming_normal_init_weight, xavier_normal_init_weight, sparse_init_weight
 from utils.classes import CLASSES
 from utils.ohem import ProbOhemCrossEntropy2d
@@ -39,6 +39,9 @@ parser.add_argument('--port', default=None, type=int)
 parser.add_argument('--num', default=42, type=int)
 parser.add_argument('--consistency_rampup', type=float, default=200.0, help='consistency_rampup')
 parser.add_argument('--consistency', type=float, default=0.1, help='consistency')
+parser.add_argument('--log_interval', type=int, default=20, help='iterations between tensorboard loss scalars')
+parser.add_argument('--compile', type=int, default=1, help='compile the training forwards with torch.compile')
+parser.add_argument('--debug', type=int, default=0, help='enable autograd anomaly detection')
 
 def sigmoid_rampup(current, rampup_length):
     """Exponential rampup from https://arxiv.org/abs/1610.02242"""
@@ -75,15 +78,23 @@ def main():
 
     cudnn.enabled = True
     cudnn.benchmark = True
+    torch.set_float32_matmul_precision('high')
+    # anomaly detection hooks every backward node, keep it off the hot path unless debugging
+    torch.autograd.set_detect_anomaly(bool(args.debug))
     start_time = time.time()
 
     model = unet_3D_mt(in_chns=1, class_num=cfg['nclass']).cuda()
     model = kaiming_normal_init_weight(model)
     
     local_rank = int(os.environ["LOCAL_RANK"])
-    model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    # SyncBatchNorm syncs every forward, only worth it while per-GPU batches are too small for stable statistics.
+    # gated on the configured per-GPU batch_size, the student forward itself normalises 2 x batch_size samples
+    if cfg['batch_size'] < 4:
+        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    model = model.to(memory_format=torch.channels_last_3d)
     model = torch.nn.parallel.DistributedDataParallel(
-        model, device_ids=[local_rank], broadcast_buffers=False, output_device=local_rank)
+        model, device_ids=[local_rank], broadcast_buffers=False, output_device=local_rank,
+        gradient_as_bucket_view=True, bucket_cap_mb=100, static_graph=True)
 
     model_ema = deepcopy(model)
     state_dict = torch.load(args.teacher_ckpt, weights_only=False)
@@ -91,6 +102,19 @@ def main():
     model_ema.eval()
     for param in model_ema.parameters():
         param.requires_grad = False
+    # cached once so that the EMA update is a handful of fused foreach kernels per iteration
+    params, ema_params = list(model.parameters()), list(model_ema.parameters())
+    buffers = [b for b in model.buffers() if b.is_floating_point()]
+    ema_buffers = [b for b in model_ema.buffers() if b.is_floating_point()]
+    int_buffers = [b for b in model.buffers() if not b.is_floating_point()]
+    ema_int_buffers = [b for b in model_ema.buffers() if not b.is_floating_point()]
+
+    # compiled wrappers are only used for the fixed-shape training forwards, checkpoints and
+    # validation keep using the plain modules so state_dict keys stay unchanged
+    model_fwd, model_ema_fwd = model, model_ema
+    if args.compile:
+        model_fwd = torch.compile(model, dynamic=False)
+        model_ema_fwd = torch.compile(model_ema, dynamic=False)
         
     optimizer = AdamW( 
         params=model.parameters(),
@@ -114,16 +138,16 @@ def main():
     trainset_l = Flare3Dataset('train_l', args, cfg['crop_size'], nsample=len(trainset_u.name_list))
     valset = Flare3Dataset('val', args, cfg['crop_size'])
     
-    trainsampler_l = DistributedSampler(trainset_l)
-    trainloader_l = DataLoader(trainset_l, batch_size=cfg['batch_size'], pin_memory=True, num_workers=6, drop_last=True, sampler=trainsampler_l)
-
-    trainsampler_u = DistributedSampler(trainset_u)
-    trainloader_u = DataLoader(trainset_u, batch_size=cfg['batch_size'], pin_memory=True, num_workers=6, drop_last=True, sampler=trainsampler_u)
+    # a single loader yields (labeled, unlabeled) pairs, so one worker pool feeds both streams
+    trainset = CombinedDataset(trainset_l, trainset_u)
+    trainsampler = DistributedSampler(trainset)
+    trainloader = DataLoader(trainset, batch_size=cfg['batch_size'], pin_memory=True, num_workers=8, drop_last=True,
+                             sampler=trainsampler, persistent_workers=True, prefetch_factor=4)
     valsampler = DistributedSampler(valset)
     valloader = DataLoader(valset, batch_size=1, pin_memory=True, num_workers=1, drop_last=False, sampler=valsampler)                           # val batch_size must be 1
     
     
-    total_iters = len(trainloader_u) * cfg['epochs']
+    total_iters = len(trainloader) * cfg['epochs']
     if rank == 0:
         print('Total iters: %d' % total_iters)
     pre_best_dice1, pre_best_dice2 = 0.78, 0.78
@@ -156,69 +180,68 @@ def main():
         total_loss_s2 = AverageMeter()
         total_mask_ratio = AverageMeter()
 
-        if hasattr(trainloader_l.sampler, "set_epoch"):
-            trainloader_l.sampler.set_epoch(epoch)
-        if hasattr(trainloader_u.sampler, "set_epoch"):
-            trainloader_u.sampler.set_epoch(epoch)
-
-        trainloader_l.sampler.set_epoch(epoch)
-        trainloader_u.sampler.set_epoch(epoch)
+        trainloader.sampler.set_epoch(epoch)
 
-        loader = zip(trainloader_l, trainloader_u)
         model.train()
         is_best = False
         for i, ((img_x, mask_x),
-                (img_u_w, img_u_s, ignore_mask)) in enumerate(loader):
+                (img_u_w, img_u_s, ignore_mask)) in enumerate(trainloader):
             img_x, mask_x = img_x.cuda(), mask_x.cuda()
             img_u_w, img_u_s = img_u_w.cuda(), img_u_s.cuda()
             ignore_mask = ignore_mask.cuda()
             with torch.no_grad():           
-                pred_u_w = model_ema(img_u_w).detach()
+                pred_u_w = model_ema_fwd(img_u_w).detach()
                 conf_u_w = pred_u_w.softmax(dim=1).max(dim=1)[0]
                 mask_u_w = pred_u_w.argmax(dim=1)
             
-            pred_x = model(img_x)
-            pred_u_s = model(img_u_s1)
+            # one student forward over labeled and strongly augmented unlabeled images
+            pred = model_fwd(torch.cat((img_x, img_u_s)))
+            pred_x, pred_u_s = pred.split([img_x.shape[0], img_u_s.shape[0]])
                  
             loss_x = criterion_l(pred_x, mask_x)
-            loss_u_s = criterion_u(pred_u_s, mask_u_w)
-            loss_u_s = loss_u_s * ((conf_u_w >= cfg['conf_thresh']) & (ignore_mask != 255))
-            loss_u_s = loss_u_s.sum() / (ignore_mask != 255).sum().item()
+            valid = ignore_mask != 255
+            keep = (conf_u_w >= cfg['conf_thresh']) & valid
+            denom = valid.sum().clamp_min(1)
+            loss_u_s = (criterion_u(pred_u_s, mask_u_w) * keep).sum() / denom
             consistency_weight = get_current_consistency_weight(iter_num // 200)
             loss = (loss_x + loss_u_s) / 2.0
             
             iter_num = iter_num + 1
             optimizer.zero_grad()
-            torch.autograd.set_detect_anomaly(True)
             loss.backward()
             optimizer.step()
 
-            total_loss.update(loss.item())
-            total_loss_x.update(loss_x.item())
-            total_loss_s.update(loss_u_s.item())
-            mask_ratio = ((conf_u_w >= cfg['conf_thresh']) & (ignore_mask != 255)).sum().item() / (ignore_mask != 255).sum()
-            total_mask_ratio.update(mask_ratio.item())
+            # meters accumulate on the GPU, the host only syncs when they are logged
+            total_loss.update(loss.detach())
+            total_loss_x.update(loss_x.detach())
+            total_loss_s.update(loss_u_s.detach())
+            mask_ratio = keep.sum() / denom
+            total_mask_ratio.update(mask_ratio)
 
-            iters = epoch * len(trainloader_u) + i
+            iters = epoch * len(trainloader) + i
             lr = cfg['lr'] * (1 - iters / total_iters) ** 0.9
             optimizer.param_groups[0]["lr"] = lr
             ema_ratio = min(1 - 1 / (iters + 1), 0.996)
             
-            for param, param_ema in zip(model.parameters(), model_ema.parameters()):
-                param_ema.copy_(param_ema * ema_ratio + param.detach() * (1 - ema_ratio))
-            for buffer, buffer_ema in zip(model.buffers(), model_ema.buffers()):
-                buffer_ema.copy_(buffer_ema * ema_ratio + buffer.detach() * (1 - ema_ratio))
+            with torch.no_grad():
+                torch._foreach_mul_(ema_params, ema_ratio)
+                torch._foreach_add_(ema_params, params, alpha=1 - ema_ratio)
+                torch._foreach_mul_(ema_buffers, ema_ratio)
+                torch._foreach_add_(ema_buffers, buffers, alpha=1 - ema_ratio)
+                # integer buffers (BN num_batches_tracked) cannot be averaged in place
+                torch._foreach_copy_(ema_int_buffers, int_buffers)
                 
             if rank == 0:
                 writer.add_scalar(
                 'consistency_weight/consistency_weight', consistency_weight, iter_num)
-                writer.add_scalar('train/loss_all', loss.item(), iters)
                 writer.add_scalar('train/lr', lr, iters)
-                writer.add_scalar('train/loss_x', loss_x.item(), iters)
-                writer.add_scalar('train/loss_s', loss_u_s.item(), iters)
-                writer.add_scalar('train/mask_ratio', mask_ratio, iters)
+                if iters % args.log_interval == 0:
+                    writer.add_scalar('train/loss_all', loss.item(), iters)
+                    writer.add_scalar('train/loss_x', loss_x.item(), iters)
+                    writer.add_scalar('train/loss_s', loss_u_s.item(), iters)
+                    writer.add_scalar('train/mask_ratio', mask_ratio.item(), iters)
 
-                if (i % (len(trainloader_u) // 3) == 0):
+                if (i % (len(trainloader) // 3) == 0):
                     logger.info('Iters: {}/{}, LR: {:.7f}, Total loss: {:.3f}, Loss x: {:.3f}, Loss s: {:.3f}, consistency_weight: {:.5f}, Mask ratio: {:.3f}'.format(
                         iter_num, total_iters, lr, total_loss.avg, total_loss_x.avg, total_loss_s.avg, consistency_weight, total_mask_ratio.avg))
         if iter_num >= (0.7 * total_iters) and epoch % 5 == 0: